@@ -1,19 +1,25 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Optional
+from contextlib import asynccontextmanager
+from functools import partial
 import os
-import uvicorn
 import asyncio
+import random
 from datetime import datetime
 import logging
 import google.generativeai as genai
 from dotenv import load_dotenv
 import base64
+import hashlib
 import io
-import json
-import re
+import orjson
 from PIL import Image as PILImage
+from google.api_core import exceptions as google_exceptions
+from tenacity import AsyncRetrying, stop_after_attempt, wait_exponential, wait_fixed, wait_random
+import diskcache
 
 # load environment variables from .env file
 load_dotenv()
@@ -22,24 +28,77 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# initialize genai
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-model = genai.GenerativeModel("gemini-2.0-flash")
+MAX_FILE_SIZE = 10 * 1024 * 1024  # limit uploads to 10MB
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# refuse to decode images larger than this to guard against decompression bombs
+PILImage.MAX_IMAGE_PIXELS = 24_000_000
+
+# leading bytes of the image formats we accept
+_SUPPORTED_MAGIC = (
+  (b"\x89PNG\r\n\x1a\n", "image/png"),
+  (b"\xff\xd8\xff", "image/jpeg"),
+)
+
+# cache parsed Gemini results on disk, keyed by image hash
+cache = diskcache.Cache("./.gemini_cache")
+CACHE_EXPIRE = 24 * 60 * 60  # seconds
+
+# coalesce concurrent analyses into a single multi-image Gemini call
+BATCH_MAX_SIZE = 4
+BATCH_MAX_WAIT = 0.05  # seconds
+BATCH_MAX_BYTES = 15 * 1024 * 1024  # stay below Gemini's inline request size limit
+
+# quota errors back off for long enough to let the budget recover (4/8/16/32s),
+# anything else is treated as transient and retried quickly
+_QUOTA_WAIT = wait_exponential(multiplier=4, max=60) + wait_random(0, 2)
+_QUOTA_STOP = stop_after_attempt(5)
+_TRANSIENT_WAIT = wait_fixed(0.2) + wait_random(0, 0.2)
+_TRANSIENT_STOP = stop_after_attempt(3)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  """Initialize the Gemini client once the event loop is running."""
+
+  # the SDK caches one gRPC channel per process, so every request reuses the same
+  # HTTP/2 connection to Gemini instead of paying for a new TLS handshake
+  genai.configure(api_key=os.getenv("GEMINI_API_KEY"), transport="grpc")
+  app.state.model = genai.GenerativeModel("gemini-2.0-flash")
+  logger.info("Gemini client initialized")
+
+  app.state.batch_queue = AsyncBatchQueue(
+    partial(gemini_batch, app.state.model),
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_time=BATCH_MAX_WAIT
+  )
+  app.state.batch_queue.start()
+
+  yield
+
+  await app.state.batch_queue.stop()
+  cache.close()
+
 
 app = FastAPI(
   title="Flood Analyzer API",
   description="An API for analyzing flood images and generating reports using Google Gemini.",
-  version="1.0.0"
+  version="1.0.0",
+  lifespan=lifespan,
+  default_response_class=ORJSONResponse
 )
 
-# CORSMiddleware
-app.add_middleware(
-  CORSMiddleware,
-  allow_origins=["*"],
-  allow_methods=["*"],
-  allow_headers=["*"],
-  allow_credentials=True,
-)
+# CORSMiddleware - only enabled for the comma-separated origins listed in ALLOWED_ORIGINS
+ALLOWED_ORIGINS = tuple(origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", "").split(",") if origin.strip())
+
+if ALLOWED_ORIGINS:
+  app.add_middleware(
+    CORSMiddleware,
+    allow_origins=ALLOWED_ORIGINS,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    allow_credentials=True,
+  )
 
 class CoordinateRequest(BaseModel):
   latitude: float
@@ -55,81 +114,312 @@ class AnalysisResponse(BaseModel):
   message: str
 
 
+
+# instructions sent to Gemini along with every image
+_PROMPT = """
+    Analyze this terrain image for flood risk assessment.
+    
+    Please provide:
+    1. Risk Level (Low/Medium/High/Very High)
+    2. Description of the risk based on what you see
+    3. 3-5 specific recommendations
+    4. Estimated elevation in meters
+    5. Estimated distance from water bodies in meters
+    6. What water bodies or flood risks you can identify in the image
+
+    Format your response as JSON with these fields:
+    - risk_level
+    - description
+    - recommendations (array of strings)
+    - elevation (number)
+    - distance_from_water (number)
+    - image_analysis (string describing what you see)
+    """
+
+DEFAULT_RECOMMENDATIONS = (
+  "Monitor local weather forecasts",
+  "Ensure proper drainage",
+  "Have an evacuation plan"
+)
+
+# values used when the Gemini response cannot be parsed
+DEFAULT_ANALYSIS = {
+  "risk_level": "Medium",
+  "description": "Analysis Completed with default values.",
+  "recommendations": DEFAULT_RECOMMENDATIONS,
+  "elevation": 50.0,
+  "distance_from_water": 1000.0
+}
+
+
+def _extract_json(text: str) -> Optional[str]:
+  """Return the first balanced JSON object in the text, scanning it once."""
+
+  start = text.find("{")
+  if start == -1:
+    return None
+
+  depth = 0
+  in_string = False
+  escaped = False
+
+  for i in range(start, len(text)):
+    char = text[i]
+
+    if in_string:
+      if escaped:
+        escaped = False
+      elif char == "\\":
+        escaped = True
+      elif char == '"':
+        in_string = False
+    elif char == '"':
+      in_string = True
+    elif char == "{":
+      depth += 1
+    elif char == "}":
+      depth -= 1
+      if depth == 0:
+        return text[start:i + 1]
+
+  return None
+
+
+def detect_image_type(data: bytes) -> Optional[str]:
+  """Return the MIME type of the image based on its magic bytes, or None if unsupported."""
+
+  for magic, mime_type in _SUPPORTED_MAGIC:
+    if data.startswith(magic):
+      return mime_type
+
+  if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+    return "image/webp"
+
+  return None
+
+
+def decode_image(image_data: bytes) -> PILImage.Image:
+  """Decode an image whose format could not be detected from its magic bytes to RGB."""
+
+  image = PILImage.open(io.BytesIO(image_data))
+
+  if image.mode != "RGB":
+    image = image.convert("RGB")
+
+  return image
+
+
+def _normalize_analysis(parsed_data: dict) -> dict:
+  """Fill in missing fields of a single analysis returned by Gemini."""
+
+  return {
+    "risk_level": parsed_data.get("risk_level", "Medium"),
+    "description": parsed_data.get("description", "Analysis Completed."),
+    "recommendations": parsed_data.get("recommendations", []),
+    "elevation": parsed_data.get("elevation", 50.0),
+    "distance_from_water": parsed_data.get("distance_from_water", 1000.0),
+    "image_analysis": parsed_data.get("image_analysis", "")
+  }
+
+
 def parse_gemini_response(response_text: str) -> dict:
   """Parse the Gemini AI response to extract structured data."""
 
   try:
     # try to extract JSON from the response 
-    json_match = re.search(r"\{.*\}", response_text, re.DOTALL)
-
-    if json_match:
-      json_str = json_match.group()
-      parsed_data = json.loads(json_str)
+    json_str = _extract_json(response_text)
 
-      return {
-        "risk_level": parsed_data.get("risk_level", "Medium"),
-        "description": parsed_data.get("description", "Analysis Completed."),
-        "recommendations": parsed_data.get("recommendations", []),
-        "elevation": parsed_data.get("elevation", 50.0),
-        "distance_from_water": parsed_data.get("distance_from_water", 1000.0),
-        "image_analysis": parsed_data.get("image_analysis", "")
-      }
+    if json_str:
+      return _normalize_analysis(orjson.loads(json_str))
     
   except Exception as e: 
     logger.error(f"Error analyzing image: {str(e)}")
-    return {
-        "risk_level": "Medium",
-        "description": "Analysis Completed with default values.",
-        "recommendations": ["Monitor local weather forecasts", "Ensure proper drainage", "Have an evacuation plan"],
-        "elevation": 50.0,
-        "distance_from_water": 1000.0,
-        "image_analysis": response_text
-      }
+    return {**DEFAULT_ANALYSIS, "image_analysis": response_text}
 
 
-def generate_image_risk_assessment() -> dict:
-  """Generate a simulated risk assessment for testing purposes."""
-  import random
+def parse_gemini_batch_response(response_text: str, count: int) -> list[dict]:
+  """Parse a multi-image Gemini response into one analysis per image, in order."""
 
-  risk_level = random.choice(["Low", "Medium", "High", "Very High"])
+  json_str = _extract_json(response_text)
 
-  descriptions = {
-    "Low": "Image analysis shows low flood risk terrain.",
-    "Medium": "Image analysis indicates moderate flood risk with some water bodies nearby.",
-    "High": "Image analysis reveals high flood risk characteristics.",
-    "Very High": "Image analysis shows very high flood risk indicators."
-  }
+  if not json_str:
+    raise ValueError("No JSON object found in batched Gemini response")
 
-  # generate recommendations 
-  recommendations = {
-    "Low": [
-      "Continue monitoring terrain changes",
-      "Maintain current drainage systems",
-      "Stay informed about weather patterns"
-    ],
-    "Medium": [
-      "Improve drainage infrastructure",
-      "Consider flood monitoring systems",
-      "Develop emergency response plan"
-    ],
-    "High" : [
-      "Install comprehensive flood barriers",
-      "Implement early warning systems",
-      "Consider structural reinforcements"
-    ],
-    "Very High": [
-      "Immediate flood protection measures needed",
-      "Consider relocation to higher ground",
-      "Implement comprehensive emergency protocols"
-    ]
-  }
+  results = orjson.loads(json_str).get("results", [])
+
+  if len(results) != count:
+    raise ValueError(f"Expected {count} results in batched Gemini response, got {len(results)}")
+
+  return [_normalize_analysis(result) for result in results]
+
+
+async def gemini_batch(model: genai.GenerativeModel, requests: list[tuple]) -> list[dict]:
+  """Analyze a batch of (image,) requests with as few Gemini calls as possible."""
+
+  if len(requests) == 1:
+    image, = requests[0]
+    response = await model.generate_content_async([_PROMPT, image])
+    return [parse_gemini_response(response.text)]
+
+  total_bytes = sum(len(image["data"]) for image, in requests if isinstance(image, dict))
+
+  if total_bytes > BATCH_MAX_BYTES:
+    # too large for a single request - analyze the images side by side instead
+    results = await asyncio.gather(*(gemini_batch(model, [item]) for item in requests))
+    return [result for result, in results]
+
+  # send the prompt once followed by the labelled images
+  contents = [_PROMPT + f"""
+    You are given {len(requests)} images, each preceded by its label (Image 1, Image 2, ...).
+    Analyze each image independently and respond with a single JSON object of the form
+    {{"results": [...]}} containing one object with the fields above per image, in the same order.
+    """]
+
+  for index, (image,) in enumerate(requests, start=1):
+    contents.extend([f"Image {index}:", image])
+
+  response = await model.generate_content_async(contents)
+  return parse_gemini_batch_response(response.text, len(requests))
+
+
+class AsyncBatchQueue:
+  """Collect concurrent requests and dispatch them to process_fn in batches.
+
+  A batch is sent once it holds max_batch_size requests or max_wait_time seconds
+  have passed since its first request arrived. process_fn receives the list of
+  request arguments and must return one result per request, in the same order.
+  """
+
+  def __init__(self, process_fn, max_batch_size: int = 4, max_wait_time: float = 0.05):
+    self.process_fn = process_fn
+    self.max_batch_size = max_batch_size
+    self.max_wait_time = max_wait_time
+    self._queue: asyncio.Queue = asyncio.Queue()
+    self._worker: Optional[asyncio.Task] = None
+    self._pending: set = set()
+
+  def start(self):
+    self._worker = asyncio.create_task(self._run())
+
+  async def stop(self):
+    if self._worker is not None:
+      self._worker.cancel()
+      await asyncio.gather(self._worker, return_exceptions=True)
+
+    # let batches already sent to Gemini finish
+    await asyncio.gather(*self._pending, return_exceptions=True)
+
+  async def add_request(self, *args) -> asyncio.Future:
+    """Queue a request and return a future resolving to its result."""
+
+    future = asyncio.get_running_loop().create_future()
+    await self._queue.put((args, future))
+    return future
+
+  async def _run(self):
+    loop = asyncio.get_running_loop()
+
+    while True:
+      batch = [await self._queue.get()]
+      deadline = loop.time() + self.max_wait_time
+
+      while len(batch) < self.max_batch_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+          break
+
+        try:
+          batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+        except asyncio.TimeoutError:
+          break
+
+      # dispatch in the background so new requests keep being collected meanwhile
+      task = asyncio.create_task(self._dispatch(batch))
+      self._pending.add(task)
+      task.add_done_callback(self._pending.discard)
+
+  async def _dispatch(self, batch: list):
+    try:
+      results = await self.process_fn([args for args, _ in batch])
+
+      for (_, future), result in zip(batch, results):
+        if not future.done():
+          future.set_result(result)
+
+    except Exception as e:
+      for _, future in batch:
+        if not future.done():
+          future.set_exception(e)
+
+
+def _is_quota_error(error: BaseException) -> bool:
+  error_str = str(error)
+  return isinstance(error, google_exceptions.ResourceExhausted) or "RESOURCE_EXHAUSTED" in error_str or "quota" in error_str.lower()
+
+
+def _retry_wait(retry_state) -> float:
+  """Pick the back-off policy based on the error of the last attempt."""
+
+  if _is_quota_error(retry_state.outcome.exception()):
+    return _QUOTA_WAIT(retry_state)
+
+  return _TRANSIENT_WAIT(retry_state)
+
+
+def _retry_stop(retry_state) -> bool:
+  """Pick the attempt limit based on the error of the last attempt."""
+
+  if _is_quota_error(retry_state.outcome.exception()):
+    return _QUOTA_STOP(retry_state)
+
+  return _TRANSIENT_STOP(retry_state)
+
+
+def _log_retry(retry_state):
+  error = retry_state.outcome.exception()
+  kind = "Quota exceeded" if _is_quota_error(error) else "Transient error"
+  logger.warning(f"Gemini API attempt {retry_state.attempt_number} failed: {str(error)}")
+  logger.info(f"{kind}, retrying in {retry_state.next_action.sleep:.1f} seconds...")
+
+
+# simulated assessments used when Gemini is unavailable: (risk level, description, recommendations)
+_FALLBACK = (
+  ("Low", "Image analysis shows low flood risk terrain.", (
+    "Continue monitoring terrain changes",
+    "Maintain current drainage systems",
+    "Stay informed about weather patterns"
+  )),
+  ("Medium", "Image analysis indicates moderate flood risk with some water bodies nearby.", (
+    "Improve drainage infrastructure",
+    "Consider flood monitoring systems",
+    "Develop emergency response plan"
+  )),
+  ("High", "Image analysis reveals high flood risk characteristics.", (
+    "Install comprehensive flood barriers",
+    "Implement early warning systems",
+    "Consider structural reinforcements"
+  )),
+  ("Very High", "Image analysis shows very high flood risk indicators.", (
+    "Immediate flood protection measures needed",
+    "Consider relocation to higher ground",
+    "Implement comprehensive emergency protocols"
+  ))
+)
+
+_RNG = random.Random()
+
+
+def generate_image_risk_assessment() -> dict:
+  """Generate a simulated risk assessment for testing purposes."""
+
+  risk_level, description, recommendations = _RNG.choice(_FALLBACK)
 
   return {
     "risk_level": risk_level,
-    "description": descriptions[risk_level],
-    "recommendations": recommendations[risk_level],
-    "elevation": round(random.uniform(10, 100), 1),  # Simulated elevation
-    "distance_from_water": round(random.uniform(200, 2000), 1)  # Simulated distance from water bodies
+    "description": description,
+    "recommendations": recommendations,
+    "elevation": round(_RNG.uniform(10, 100), 1),  # Simulated elevation
+    "distance_from_water": round(_RNG.uniform(200, 2000), 1)  # Simulated distance from water bodies
   }
 
 
@@ -144,7 +434,7 @@ async def root():
 
 
 @app.post("/api/analyze/image")
-async def analyze_image(file: UploadFile = File(...)):
+async def analyze_image(request: Request, file: UploadFile = File(...)):
   """
   Analyze flood risk based on uploaded image using gemini ai
   """
@@ -155,71 +445,62 @@ async def analyze_image(file: UploadFile = File(...)):
     if not file.content_type.startswith("image/"):
       raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
     
-    # read image data 
-    image_data = await file.read()
+    # read image data in chunks, rejecting oversized uploads before they are fully buffered
+    buffer = bytearray()
 
-    if len(image_data) > 10 * 1024 * 1024:  # limit to 10MB
-      raise HTTPException(status_code=400, detail="File size exceeds the limit of 10MB.")
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+      buffer.extend(chunk)
 
-    try:
-      image = PILImage.open(io.BytesIO(image_data))
+      if len(buffer) > MAX_FILE_SIZE:
+        raise HTTPException(status_code=413, detail="File size exceeds the limit of 10MB.")
 
-      if image.mode != "RGB":
-        image = image.convert("RGB")
+    image_data = bytes(buffer)
 
-    except Exception as img_error:
-      logger.error(f"Error processing image: {str(img_error)}")
-      raise HTTPException(status_code=400, detail="Invalid image format.")
+    mime_type = detect_image_type(image_data)
 
-    prompt = """
-    Analyze this terrain image for flood risk assessment.
-    
-    Please provide:
-    1. Risk Level (Low/Medium/High/Very High)
-    2. Description of the risk based on what you see
-    3. 3-5 specific recommendations
-    4. Estimated elevation in meters
-    5. Estimated distance from water bodies in meters
-    6. What water bodies or flood risks you can identify in the image
+    # return the cached analysis if this exact image was analyzed before
+    cache_key = hashlib.blake2b(image_data, digest_size=16).hexdigest()
+    parsed_data = cache.get(cache_key)
 
-    Format your response as JSON with these fields:
-    - risk_level
-    - description
-    - recommendations (array of strings)
-    - elevation (number)
-    - distance_from_water (number)
-    - image_analysis (string describing what you see)
-    """
+    if parsed_data is not None:
+      logger.info(f"Cache hit for image: {file.filename}")
+      return {
+        "success": True,
+        **parsed_data,
+        "ai_analysis": parsed_data.get("image_analysis", ""),
+        "message": "Image analyzed successfully using Gemini AI."
+      }
 
-    max_retries = 3
-    retry_delay = 2  # seconds
-    
-    for attempt in range(max_retries):
+    # known formats are sent to Gemini as raw bytes, anything else is decoded with PIL first
+    if mime_type is not None:
+      image = {"mime_type": mime_type, "data": image_data}
+
+    else:
       try:
-        # Use gemini-2.0-flash model - more stable with higher quotas
-        response = model.generate_content([prompt, image])
-
-        parsed_data = parse_gemini_response(response.text)
-        break  # Success - exit retry loop
-
-      except Exception as genai_error:
-        error_str = str(genai_error)
-        logger.warning(f"Gemini API attempt {attempt + 1} failed: {error_str}")
-        
-        if attempt < max_retries - 1:
-          # Check if it's a quota error - wait longer before retry
-          if "RESOURCE_EXHAUSTED" in error_str or "quota" in error_str.lower():
-            retry_delay = retry_delay * 2  # Exponential backoff for quota errors
-            logger.info(f"Quota exceeded, retrying in {retry_delay} seconds...")
-          
-          import time
-          time.sleep(retry_delay)
-        else:
-          # All retries exhausted - use fallback data
-          logger.error(f"All Gemini API retries failed. Using fallback data. Error: {error_str}")
-          parsed_data = generate_image_risk_assessment()
-          parsed_data["image_analysis"] = "Image analysis was not available due to API quota limits. Using simulated assessment based on historical flood data patterns."
+        image = decode_image(image_data)
+
+      except PILImage.DecompressionBombError as bomb_error:
+        logger.error(f"Rejected oversized image: {str(bomb_error)}")
+        raise HTTPException(status_code=400, detail="Image dimensions are too large.")
 
+      except Exception as img_error:
+        logger.error(f"Error processing image: {str(img_error)}")
+        raise HTTPException(status_code=400, detail="Invalid image format.")
+
+    try:
+      async for attempt in AsyncRetrying(wait=_retry_wait, stop=_retry_stop, before_sleep=_log_retry, reraise=True):
+        with attempt:
+          # Use gemini-2.0-flash model - more stable with higher quotas
+          future = await request.app.state.batch_queue.add_request(image)
+          parsed_data = await future
+
+      cache.set(cache_key, parsed_data, expire=CACHE_EXPIRE)
+
+    except Exception as genai_error:
+      # All retries exhausted - use fallback data
+      logger.error(f"All Gemini API retries failed. Using fallback data. Error: {str(genai_error)}")
+      parsed_data = generate_image_risk_assessment()
+      parsed_data["image_analysis"] = "Image analysis was not available due to API quota limits. Using simulated assessment based on historical flood data patterns."
 
     return {
       "success": True,
@@ -228,10 +509,9 @@ async def analyze_image(file: UploadFile = File(...)):
       "message": "Image analyzed successfully using Gemini AI."
     }
 
+  except HTTPException:
+    raise
+
   except Exception as e:
     logger.error(f"Error analyzing image: {str(e)}")
     raise HTTPException(status_code=500, detail="An error occurred while analyzing the image.")
-
-if __name__ == "__main__":
-  port = int(os.getenv("PORT", 10000))
-  uvicorn.run("main:app", host="0.0.0.0", port=port, log_level="info")
@@ -11,9 +11,16 @@ sys.path.append(str(Path(__file__).parent))
 
 if __name__ == "__main__":
   port = int(os.getenv("PORT", 10000))
-  host = "0.0.0.0"
+  host = os.getenv("HOST", "0.0.0.0")
+  debug = os.getenv("DEBUG", "0") == "1"
 
-  print(f"Starting Flood Analyzer API on {host}:{port}...")
+  # the reloader only supports a single worker, so it is reserved for local development
+  if debug:
+    workers = 1
+  else:
+    workers = int(os.getenv("WORKERS", os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1)))
+
+  print(f"Starting Flood Analyzer API on {host}:{port} with {workers} workers{' (reload enabled)' if debug else ''}...")
   print("API Documentation available at:")
   print(f"  - Swagger UI: http://{host}:{port}/docs")
   print(f"  - ReDoc: http://{host}:{port}/redoc")
@@ -23,5 +30,9 @@ if __name__ == "__main__":
     'main:app', 
     host=host, 
     port=port, 
-    log_level="info"
+    log_level="info",
+    loop="uvloop",
+    http="httptools",
+    workers=workers,
+    reload=debug
   )